@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+interleaved streaming writes to several files inside of one container
+
+fragmentation is measured on the mounted session, see FileStructure.fragmentation
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+from fly import Fly, update_log_level
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='fly allocator benchmark')
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--block', type=int, default=4096)
+    parser.add_argument('--blocks', type=int, default=256)
+    return parser.parse_args()
+
+
+def bench(files, block, blocks):
+    with tempfile.TemporaryDirectory() as tmp:
+        container = Path(tmp) / 'container'
+        container.write_bytes(b'fly benchmark container')
+
+        class Args:
+            fname = container
+            mountpoint = ''
+
+        fly = Fly()
+        fly.add_args(Args())
+        host_growths = 0
+        host_size = 0
+        buf = b'x' * block
+        start = time.perf_counter()
+        for i in range(blocks):
+            for n in range(files):
+                fly.write(f'/file_{n}', buf, i * block)
+                size = container.stat().st_size
+                if size > host_size:
+                    host_growths += 1
+                    host_size = size
+        elapsed = time.perf_counter() - start
+
+        frag = fly.fs_structure.fragmentation()
+        written = files * block * blocks
+        speed = written / elapsed / 2**20
+        print(f'written: {written} bytes in {elapsed:.3f}s ({speed:.1f} MiB/s)')  # noqa: T201
+        print(f'container: {host_size} bytes, grown {host_growths} times')  # noqa: T201
+        print(  # noqa: T201
+            f'extents: {len(fly.fs_structure.files_list)} '
+            f'holes: {frag.free_extents} free: {frag.free} largest free: {frag.largest_free}'
+        )
+        print(f'internal: {frag.internal:.3f} external: {frag.external:.3f}')  # noqa: T201
+
+
+def main():
+    args = parse_args()
+    update_log_level(logging.INFO)
+    bench(args.files, args.block, args.blocks)
+
+
+if __name__ == '__main__':
+    main()
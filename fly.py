@@ -28,6 +28,12 @@ fuse.fuse_python_api = (0, 2)
 TIME_PAT = re.compile(r'.*\/\d+\.\d+')
 MAGIC_BYTES = b'0FLYFMT0'
 # num files, array[name_length, name]
+KiB = 1024
+MiB = 1024 * KiB
+# reservations for small files, bigger extents grow in whole chunks
+SIZE_CLASSES = (4 * KiB, 16 * KiB, 64 * KiB, 256 * KiB, 1 * MiB)
+CHUNK_SIZE = 1 * MiB
+COPY_BUFFER = 1 * MiB
 
 if not hasattr(fuse, '__version__'):
     raise RuntimeError("your fuse-py doesn't know of fuse.__version__, probably it's too old.")
@@ -50,6 +56,16 @@ def update_log_level(level):
         logging.getLogger(name).setLevel(level)
 
 
+def size_class(size):
+    """
+    smallest reservation that fits size
+    """
+    for klass in SIZE_CLASSES:
+        if size <= klass:
+            return klass
+    return -(-size // CHUNK_SIZE) * CHUNK_SIZE
+
+
 def call_fuse_exit(mountpoint):
     # start with nohup
     multiprocessing.Process(target=auto_unmount, args=(mountpoint,)).start()
@@ -148,6 +164,78 @@ class FileWrapper:
             f.write(bytes)
         self.reset_handlers()
 
+    def reserve(self, offset, length):
+        """
+        allocate host blocks for the extent up front
+        """
+        log.debug(f'reserve {offset=} {length=}')
+        with self.path.open('r+b') as f:
+            try:
+                if not hasattr(os, 'posix_fallocate'):
+                    raise OSError(errno.EOPNOTSUPP, 'posix_fallocate is not available')
+                os.posix_fallocate(f.fileno(), offset, length)
+            except OSError as e:
+                if e.errno != errno.EOPNOTSUPP:
+                    raise
+                log.debug('no fallocate, just extend the file')
+                if f.seek(0, os.SEEK_END) < offset + length:
+                    f.truncate(offset + length)
+        self.reset_handlers()
+
+    def zero(self, offset, size):
+        """
+        overwrite part of the file with zeros, so stale data never leaks
+        """
+        log.debug(f'zero {offset=} {size=}')
+        with self.path.open('r+b') as f:
+            f.seek(offset, os.SEEK_SET)
+            while size > 0:
+                chunk = min(size, COPY_BUFFER)
+                f.write(b'\0' * chunk)
+                size -= chunk
+        self.reset_handlers()
+
+    def find_data_start(self, offset):
+        """
+        data area starts right after MAGIC_BYTES header, only zeroed holes can be in between
+        """
+        position = offset
+        while position > 0:
+            chunk_start = max(0, position - COPY_BUFFER)
+            chunk = self.read(position - chunk_start, chunk_start).rstrip(b'\0')
+            if chunk:
+                position = chunk_start + len(chunk)
+                break
+            position = chunk_start
+        if position < len(MAGIC_BYTES):
+            return offset
+        if self.read(len(MAGIC_BYTES), position - len(MAGIC_BYTES)) != MAGIC_BYTES:
+            return offset
+        return position
+
+    def copy(self, src, dst, size):
+        """
+        copy data between non-overlapping parts of the file
+        """
+        log.debug(f'copy {src=} {dst=} {size=}')
+        with self.path.open('r+b') as f:
+            while size > 0:
+                f.seek(src, os.SEEK_SET)
+                chunk = f.read(min(size, COPY_BUFFER))
+                if not chunk:
+                    break
+                f.seek(dst, os.SEEK_SET)
+                f.write(chunk)
+                src += len(chunk)
+                dst += len(chunk)
+                size -= len(chunk)
+        self.reset_handlers()
+
+    def truncate(self, size):
+        with self.path.open('r+b') as f:
+            f.truncate(size)
+        self.reset_handlers()
+
     def read(self, size, offset):
         log.debug(f'read {offset=} {size=}')
         self.read_handle.seek(offset, os.SEEK_SET)
@@ -159,11 +247,36 @@ class FileRecord:
     name: str
     size: int
     offset: int = 0
+    # reserved bytes starting at offset, not packed into metadata
+    capacity: int = 0
 
     def __iter__(self):
         return iter((self.name, self.size, self.offset))
 
 
+@dataclass
+class Fragmentation:
+    used: int
+    reserved: int
+    free: int
+    free_extents: int
+    largest_free: int
+
+    @property
+    def internal(self) -> float:
+        """
+        share of reserved space that doesn't hold data yet
+        """
+        return 1 - self.used / self.reserved if self.reserved else 0.0
+
+    @property
+    def external(self) -> float:
+        """
+        share of free space outside of the largest hole
+        """
+        return 1 - self.largest_free / self.free if self.free else 0.0
+
+
 class FileStructure:
     def __init__(self, structure: bytes, base_offset=0):
         """
@@ -175,6 +288,8 @@ class FileStructure:
         if structure:
             self._parse(structure)
         self.files_dict = {f.name: f for f in self.files_list}
+        self.data_start = min((f.offset for f in self.files_list), default=base_offset - 8)
+        self._derive_capacity()
 
     def _parse(self, structure):
         log.debug(f'{structure=}')
@@ -193,6 +308,15 @@ class FileStructure:
             log.debug(f'FileRecord {name=} {size=} {offset=}')
             self.files_list.append(FileRecord(name, size, offset))
 
+    def _derive_capacity(self):
+        """
+        every extent owns the space up to the next one, the last one up to metadata
+        """
+        end = self.base_offset - 8
+        for record in sorted(self.files_list, key=lambda f: (f.offset, f.size), reverse=True):
+            record.capacity = max(end - record.offset, record.size)
+            end = record.offset
+
     def pack(self):
         res = struct.pack('I', len(self.files_list))
         for name, size, offset in self.files_list:
@@ -203,37 +327,90 @@ class FileStructure:
             res += struct.pack('Q', offset)
         return res
 
+    @property
+    def end(self):
+        """
+        end of the last extent, metadata is stored right after it
+        """
+        return max((f.offset + f.capacity for f in self.files_list), default=self.data_start)
+
+    def free_extents(self):
+        """
+        holes between extents as (offset, length)
+        """
+        position = self.data_start
+        for record in sorted(self.files_list, key=lambda f: f.offset):
+            if record.offset > position:
+                yield position, record.offset - position
+            position = max(position, record.offset + record.capacity)
+
+    def fragmentation(self) -> Fragmentation:
+        """
+        state of the current session: holes are not packed into metadata, after reload a hole
+        becomes spare capacity of the extent before it (only a hole at data_start stays free)
+        """
+        holes = [length for _, length in self.free_extents()]
+        return Fragmentation(
+            used=sum(f.size for f in self.files_list),
+            reserved=sum(f.capacity for f in self.files_list),
+            free=sum(holes),
+            free_extents=len(holes),
+            largest_free=max(holes, default=0),
+        )
+
+    def _allocate(self, capacity):
+        """
+        first hole that fits capacity, otherwise the end
+        """
+        for offset, length in self.free_extents():
+            if length >= capacity:
+                return offset
+        return self.end
+
+    def _room(self, record):
+        """
+        how far record can grow in place, None when it is the last one
+        """
+        following = [
+            f.offset
+            for f in self.files_list
+            if f is not record and f.offset >= record.offset + record.capacity
+        ]
+        if not following:
+            return None
+        return min(following) - record.offset
+
     def add(self, fname, size) -> Tuple[FileRecord, int]:
         log.debug(f'{self.base_offset=}')
         if fname in self.files_dict:
             log.debug('return existing record')
-            last_file = self.files_list[-1]
-            return self.files_dict[fname], last_file.offset + last_file.size
+            return self.files_dict[fname], self.end
 
-        record = FileRecord(fname, size, 0)
+        capacity = size_class(size)
+        record = FileRecord(fname, size, self._allocate(capacity), capacity)
+        log.debug(f'Add new {record=}')
         self.files_list.append(record)
         self.files_dict[fname] = record
-
-        if len(self.files_list) > 1:
-            last_file = self.files_list[-2]
-            file_offset = last_file.offset + last_file.size
-            log.debug(f'{self.base_offset=} {file_offset=}')
-        else:
-            packed = self.pack()
-            file_offset = self.base_offset - 8
-            log.debug(f'Add new with: {self.base_offset=} {len(packed)=}')
-        record.offset = file_offset
-        last_file = self.files_list[-1]
-        self.base_offset = last_file.offset + last_file.size + 8
-        return record, last_file.offset + last_file.size
+        self.base_offset = self.end + 8
+        return record, self.end
 
     def update_size(self, fname, new_size) -> Tuple[FileRecord, int]:
         record = self.files_dict[fname]
         log.debug(f'Update size {fname=} {record.size} => {new_size}')
+        if new_size > record.capacity:
+            room = self._room(record)
+            if room is None or room >= new_size:
+                capacity = size_class(new_size)
+                record.capacity = capacity if room is None else min(capacity, room)
+            else:
+                # double on move, so a file moves only log(size) times
+                capacity = size_class(max(new_size, record.capacity * 2))
+                record.offset = self._allocate(capacity)
+                record.capacity = capacity
+            log.debug(f'New extent {record.offset=} {record.capacity=}')
         record.size = new_size
-        last_file = self.files_list[-1]
-        self.base_offset = last_file.offset + last_file.size + 8
-        return record, last_file.offset + last_file.size
+        self.base_offset = self.end + 8
+        return record, self.end
 
     def remove(self, fname):
         record = self.files_dict[fname]
@@ -260,11 +437,16 @@ class Fly(fuse.Fuse):
             fs_size = struct.unpack('Q', fs_size_packed)[0]
             log.debug(f'{meta_offset=} {fs_size=}')
             fs_bytes = self.file_wrapper.read(fs_size, meta_offset + 8)
-        base_offset = (
-            (meta_offset if meta_offset > 0 else self.dst.stat().st_size) + len(MAGIC_BYTES) + 8
-        )
+        if meta_offset > 0:
+            base_offset = meta_offset + 8
+        else:
+            base_offset = self.dst.stat().st_size + len(MAGIC_BYTES) + 8
         log.debug(f'Original file size: {self.dst.stat().st_size} {base_offset=}')
         self.fs_structure = FileStructure(fs_bytes, base_offset)
+        if self.fs_structure.files_list:
+            self.fs_structure.data_start = self.file_wrapper.find_data_start(
+                self.fs_structure.data_start
+            )
         log.info(f'Init FS with {len(self.fs_structure.files_list)} files')
 
     def getattr(self, path):
@@ -316,52 +498,118 @@ class Fly(fuse.Fuse):
         path = path[1:]
         if path in self.fs_structure.files_dict:
             return -errno.EEXIST
-        _, self.meta_offset = self.fs_structure.add(path, 0)
-        return 0
+        return self._add_empty(path)
 
     def mknod(self, path, mode, dev):
         log.debug(f'Filepath: {path} {mode=} {dev=}')
         path = path[1:]
         if path in self.fs_structure.files_dict:
             return -errno.EEXIST
-        self.fs_structure.add(path, 0)
-        return 0
+        return self._add_empty(path)
+
+    def _add_empty(self, path):
+        try:
+            if self.meta_offset == -1:
+                log.debug('no meta_offset. creating new...')
+                self.file_wrapper.write_end(MAGIC_BYTES)
+            record, self.meta_offset = self.fs_structure.add(path, 0)
+            self.file_wrapper.reserve(record.offset, record.capacity)
+            self._write_meta()
+            return 0
+        except OSError as e:
+            log.exception('add empty')
+            if path in self.fs_structure.files_dict:
+                self.fs_structure.remove(path)
+                self.meta_offset = self.fs_structure.end
+            return -e.errno
+
+    def _write_meta(self):
+        struct_bytes = self.fs_structure.pack()
+        self.file_wrapper.write(self.meta_offset, struct.pack('Q', len(struct_bytes)))
+        self.file_wrapper.write(self.meta_offset + 8, struct_bytes)
+
+        packed_offset = struct.pack('Q', self.meta_offset)
+        end_buffer = MAGIC_BYTES + packed_offset
+        end_offset = self.meta_offset + 8 + len(struct_bytes)
+        self.file_wrapper.write(end_offset, end_buffer)
+        self.file_wrapper.truncate(end_offset + len(end_buffer))
 
     def write(self, path, buf, offset):
         self._ctime = time.time()
         log.debug(f'write {path=} {len(buf)=} {offset=}')
+        path = path[1:]
+        meta_offset = self.meta_offset
+        record = self.fs_structure.files_dict.get(path)
+        snapshot = None if record is None else (record.offset, record.capacity, record.size)
         try:
-            path = path[1:]
+            extent = None
+            old_size = 0
             if self.meta_offset == -1:
                 log.debug('no meta_offset. creating new...')
                 self.file_wrapper.write_end(MAGIC_BYTES)
                 record, self.meta_offset = self.fs_structure.add(path, len(buf) + offset)
-            elif path not in self.fs_structure.files_dict:
+            elif record is None:
                 log.debug('has meta offset but new file')
                 record, self.meta_offset = self.fs_structure.add(path, len(buf) + offset)
             else:
                 log.debug('has meta offset')
-                record = self.fs_structure.files_dict[path]
+                extent = (record.offset, record.capacity)
+                old_size = record.size
                 if record.size < len(buf) + offset:
                     record, self.meta_offset = self.fs_structure.update_size(
                         path, len(buf) + offset
                     )
+            if (record.offset, record.capacity) != extent:
+                self.file_wrapper.reserve(record.offset, record.capacity)
+            moved = extent is not None and record.offset != extent[0]
+            if moved:
+                log.debug(f'move {path=} {extent=} => {record.offset}')
+                self.file_wrapper.copy(extent[0], record.offset, old_size)
+            if offset > old_size:
+                # reserved space may hold old metadata, don't expose it
+                self.file_wrapper.zero(record.offset + old_size, offset - old_size)
             log.debug(
                 f'record offset = {record.offset} {record.size} {self.fs_structure.base_offset=}'
             )
             self.file_wrapper.write(record.offset + offset, buf)
-            struct_bytes = self.fs_structure.pack()
-            self.file_wrapper.write(self.meta_offset, struct.pack('Q', len(struct_bytes)))
-            self.file_wrapper.write(self.meta_offset + 8, struct_bytes)
-
-            packed_offset = struct.pack('Q', self.meta_offset)
-            end_buffer = MAGIC_BYTES + packed_offset
-            self.file_wrapper.write_end(end_buffer)
-            return len(buf)
+            self._write_meta()
+        except OSError as e:
+            log.exception('write')
+            self._rollback_write(path, snapshot, meta_offset)
+            return -e.errno
         except:
             log.exception('write')
+            self._rollback_write(path, snapshot, meta_offset)
             return -errno.EIO
 
+        if moved:
+            # the old extent is a hole now, keep it zeroed for find_data_start
+            try:
+                self.file_wrapper.zero(*extent)
+            except OSError:
+                log.exception('zero hole')
+        return len(buf)
+
+    def _rollback_write(self, path, snapshot, meta_offset):
+        """
+        restore the record as it was before the failed write and persist it again
+        """
+        if snapshot is None:
+            if path in self.fs_structure.files_dict:
+                self.fs_structure.remove(path)
+        else:
+            record = self.fs_structure.files_dict[path]
+            record.offset, record.capacity, record.size = snapshot
+        self.fs_structure.base_offset = self.fs_structure.end + 8
+        self.meta_offset = meta_offset
+        try:
+            if meta_offset == -1:
+                self.file_wrapper.truncate(self.fs_structure.data_start - len(MAGIC_BYTES))
+            else:
+                self._write_meta()
+        except OSError:
+            log.exception('rollback write')
+
     def read(self, path, size, offset):
         self._ctime = time.time()
         log.debug(f'read {path=} {size=} {offset=}')
@@ -405,12 +653,11 @@ class Fly(fuse.Fuse):
             #     self.file_wrapper.write_end(struct.pack('Q', self.meta_offset))
             #     return 0
 
-            # if not last: copy and iteratively calculate new base
-            is_first = True
-            current_base = 0
+            # copy extents one after another: drops holes and unused capacity
             temp = tempfile.NamedTemporaryFile(delete=False)
             temp_handler = temp
             read_handle = self.dst.open('rb')
+            temp_handler.write(read_handle.read(self.fs_structure.data_start))
 
             log.debug(f'Iterate over list: {self.fs_structure.files_list}')
 
@@ -418,21 +665,19 @@ class Fly(fuse.Fuse):
                 log.debug(
                     f'processing {file_record.name=} {file_record.size=} {file_record.offset=}'
                 )
-                if is_first:
-                    is_first = False
-                    temp_handler.write(read_handle.read(file_record.offset))
-
                 if file_record.name == path:
-                    current_base = -file_record.size
                     continue
 
                 read_handle.seek(file_record.offset, os.SEEK_SET)
-                temp_handler.write(read_handle.read(file_record.size))
-
-                file_record.offset += current_base
+                data = read_handle.read(file_record.size)
+                file_record.offset = temp_handler.tell()
+                file_record.capacity = file_record.size
+                temp_handler.write(data)
 
             self.fs_structure.remove(path)
             new_meta_offset = temp_handler.tell()
+            self.meta_offset = new_meta_offset
+            self.fs_structure.base_offset = new_meta_offset + 8
             log.debug(f'{new_meta_offset=} {self.dst.name}')
             packed_bytes = self.fs_structure.pack()
             temp_handler.write(struct.pack('Q', len(packed_bytes)))
@@ -444,9 +689,7 @@ class Fly(fuse.Fuse):
 
             self.file_wrapper.reset_handlers()
             log.debug(f'{temp.name} => {self.dst}')
-            log.debug(
-                f'old: {self.dst.stat().st_size} new: {Path(temp.name).stat().st_size} {current_base=}'
-            )
+            log.debug(f'old: {self.dst.stat().st_size} new: {Path(temp.name).stat().st_size}')
             copyfile(temp.name, self.dst)
             os.unlink(temp.name)
 
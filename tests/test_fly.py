@@ -1,4 +1,16 @@
-from fly import MAGIC_BYTES, FileRecord, FileStructure, FileWrapper, Fly
+import errno
+import os
+
+from fly import (
+    CHUNK_SIZE,
+    MAGIC_BYTES,
+    SIZE_CLASSES,
+    FileRecord,
+    FileStructure,
+    FileWrapper,
+    Fly,
+    size_class,
+)
 
 
 class TestFileWrapper:
@@ -15,6 +27,16 @@ class TestFileWrapper:
         fw.remove_data(1, 3)
         assert temp_file.read_bytes() == b'\0lo\0'
 
+    def test_reserve_without_fallocate(self, tmp_path, monkeypatch):
+        def fallocate(fd, offset, length):
+            raise OSError(errno.EOPNOTSUPP, 'not supported')
+
+        monkeypatch.setattr(os, 'posix_fallocate', fallocate)
+        temp_file = tmp_path / 'test_reserve'
+        fw = FileWrapper(temp_file)
+        fw.reserve(10, 100)
+        assert temp_file.read_bytes() == b'\0' * 110
+
 
 class TestFileStructure:
     def test_empty(self):
@@ -45,6 +67,52 @@ class TestFileStructure:
             b'\x00\x00\x00\x00\x00\x00\x00\x00'
         )
 
+    def test_size_class(self):
+        assert size_class(0) == SIZE_CLASSES[0]
+        assert size_class(SIZE_CLASSES[0] + 1) == SIZE_CLASSES[1]
+        assert size_class(SIZE_CLASSES[-1] + 1) == 2 * CHUNK_SIZE
+
+    def test_grow_last_in_place(self):
+        fs = FileStructure(b'', 108)
+        fs.add('a', 10)
+        record, meta_offset = fs.update_size('a', SIZE_CLASSES[0] + 1)
+        assert record.offset == 100
+        assert record.capacity == SIZE_CLASSES[1]
+        assert meta_offset == 100 + SIZE_CLASSES[1]
+
+    def test_grow_moves_and_reuses_hole(self):
+        fs = FileStructure(b'', 8)
+        a, _ = fs.add('a', 10)
+        b, _ = fs.add('b', 10)
+        fs.update_size('a', SIZE_CLASSES[0] + 1)
+        assert a.offset == b.offset + b.capacity
+        assert list(fs.free_extents()) == [(0, SIZE_CLASSES[0])]
+
+        c, _ = fs.add('c', 10)
+        assert c.offset == 0
+        assert list(fs.free_extents()) == []
+
+    def test_fragmentation(self):
+        fs = FileStructure(b'', 8)
+        fs.add('a', 10)
+        fs.add('b', 10)
+        fs.add('c', 10)
+        fs.remove('b')
+        frag = fs.fragmentation()
+        assert frag.used == 20
+        assert frag.reserved == 2 * SIZE_CLASSES[0]
+        assert frag.free == frag.largest_free == SIZE_CLASSES[0]
+        assert frag.free_extents == 1
+        assert frag.external == 0.0
+
+    def test_capacity_from_offsets(self):
+        fs = FileStructure(b'', 8)
+        fs.add('a', 10)
+        fs.add('b', 10)
+        loaded = FileStructure(fs.pack(), fs.base_offset)
+        assert loaded.files_dict['a'].capacity == SIZE_CLASSES[0]
+        assert loaded.files_dict['b'].capacity == SIZE_CLASSES[0]
+
 
 class WrappedFly(Fly):
     def __init__(self):
@@ -68,8 +136,9 @@ class TestBasicFly:
         file1 = fly.fs_structure.files_dict['new_file']
         assert file1.size == 16
         assert file1.offset == 22 + len(MAGIC_BYTES)
+        assert file1.capacity == SIZE_CLASSES[0]
         # assert False, fly.fs_structure.files_dict
-        assert fly.fs_structure.base_offset == 22 + len(MAGIC_BYTES) + file1.size + 8
+        assert fly.fs_structure.base_offset == 22 + len(MAGIC_BYTES) + file1.capacity + 8
 
     def test_add_two_files(self, tmp_path):
         temp_file = tmp_path / 'test_add_two_files'
@@ -90,9 +159,11 @@ class TestBasicFly:
         file1 = fly.fs_structure.files_dict['new_file']
         file2 = fly.fs_structure.files_dict['new_file2']
         assert file2.size == 16
-        assert file2.offset == 22 + len(MAGIC_BYTES) + file1.size
-        assert fly.fs_structure.base_offset == 22 + len(MAGIC_BYTES) + file1.size + file2.size + 8
-        assert fly.fs_structure.base_offset == file2.offset + file2.size + 8
+        assert file2.offset == 22 + len(MAGIC_BYTES) + file1.capacity
+        assert fly.fs_structure.base_offset == (
+            22 + len(MAGIC_BYTES) + file1.capacity + file2.capacity + 8
+        )
+        assert fly.fs_structure.base_offset == file2.offset + file2.capacity + 8
 
         assert fly.file_wrapper.read(8, 22) == MAGIC_BYTES
         assert fly.read('/new_file', 8, 0) == b'new_file'
@@ -144,3 +215,250 @@ class TestBasicFly:
         assert fly.file_wrapper.read(8, 22) == MAGIC_BYTES
         assert fly.read('/new_file', 16, 0) == b'new_file12345678'
         assert fly.file_wrapper.read(8, file1.offset) == b'new_file'
+
+    def test_interleaved_writes(self, tmp_path):
+        temp_file = tmp_path / 'test_interleaved'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+
+        block = 1000
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        for i in range(20):
+            fly.write('/a', b'a' * block, i * block)
+            fly.write('/b', b'b' * block, i * block)
+
+        file_a = fly.fs_structure.files_dict['a']
+        file_b = fly.fs_structure.files_dict['b']
+        extents = sorted([file_a, file_b], key=lambda f: f.offset)
+        assert extents[0].offset + extents[0].capacity <= extents[1].offset
+        assert fly.read('/a', 20 * block, 0) == b'a' * 20 * block
+        assert fly.read('/b', 20 * block, 0) == b'b' * 20 * block
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        assert fly.read('/a', 20 * block, 0) == b'a' * 20 * block
+        assert fly.read('/b', 20 * block, 0) == b'b' * 20 * block
+        assert fly.fs_structure.files_dict['b'].capacity == file_b.capacity
+
+    def test_move_keeps_data(self, tmp_path):
+        temp_file = tmp_path / 'test_move'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        fly.write('/a', b'a_content', 0)
+        fly.write('/b', b'b_content', 0)
+        old_offset = fly.fs_structure.files_dict['a'].offset
+        fly.write('/a', b'!', SIZE_CLASSES[0])
+
+        file_a = fly.fs_structure.files_dict['a']
+        assert file_a.offset != old_offset
+        assert fly.file_wrapper.read(SIZE_CLASSES[0], old_offset) == b'\0' * SIZE_CLASSES[0]
+        expected = b'a_content' + b'\0' * (SIZE_CLASSES[0] - 9) + b'!'
+        assert fly.read('/a', len(expected), 0) == expected
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        assert fly.read('/a', len(expected), 0) == expected
+        assert fly.read('/b', 9, 0) == b'b_content'
+
+    def test_unlink_after_move(self, tmp_path):
+        temp_file = tmp_path / 'test_unlink_after_move'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+
+        content = b'x' * (SIZE_CLASSES[0] + 1)
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        fly.write('/a', b'a', 0)
+        fly.write('/b', b'b', 0)
+        fly.write('/a', content, 0)
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        assert fly.fs_structure.data_start == 22 + len(MAGIC_BYTES)
+        frag = fly.fs_structure.fragmentation()
+        assert frag.free == frag.largest_free == SIZE_CLASSES[0]
+
+        assert fly.unlink('/b') == 0
+        packed = fly.fs_structure.pack()
+        data_end = 22 + len(MAGIC_BYTES) + len(content)
+        assert fly.fs_structure.files_dict['a'].offset == 22 + len(MAGIC_BYTES)
+        assert temp_file.stat().st_size == data_end + 8 + len(packed) + len(MAGIC_BYTES) + 8
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        assert fly.file_wrapper.read(8, 22) == MAGIC_BYTES
+        assert fly.read('/a', len(content), 0) == content
+        assert 'b' not in fly.fs_structure.files_dict
+
+    def test_hole_reuse_is_zeroed(self, tmp_path):
+        temp_file = tmp_path / 'test_hole_reuse'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        fly.write('/a', b'SECRET' * 10, 0)
+        fly.write('/b', b'b', 0)
+        fly.write('/a', b'!', SIZE_CLASSES[0])
+        fly.write('/c', b'c', 30)
+
+        assert fly.fs_structure.files_dict['c'].offset == 22 + len(MAGIC_BYTES)
+        assert fly.read('/c', 31, 0) == b'\0' * 30 + b'c'
+
+        fly.write('/b', b'b', 40)
+        assert fly.read('/b', 41, 0) == b'b' + b'\0' * 39 + b'b'
+
+    def test_create_and_mknod(self, tmp_path):
+        temp_file = tmp_path / 'test_create'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        assert fly.mknod('/m', 0o644, 0) == 0
+        assert fly.create('/c', 0, 0o644) == 0
+        assert fly.create('/c', 0, 0o644) < 0
+        assert temp_file.read_bytes()[22:30] == MAGIC_BYTES
+
+        file_m = fly.fs_structure.files_dict['m']
+        file_c = fly.fs_structure.files_dict['c']
+        assert file_m.offset == 22 + len(MAGIC_BYTES)
+        assert file_c.offset == file_m.offset + SIZE_CLASSES[0]
+        assert temp_file.stat().st_size > file_c.offset + SIZE_CLASSES[0]
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        assert fly.fs_structure.files_dict['m'].size == 0
+        fly.write('/m', b'mknod', 0)
+        fly.write('/c', b'create', 0)
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        assert fly.file_wrapper.read(8, 22) == MAGIC_BYTES
+        assert fly.read('/m', 5, 0) == b'mknod'
+        assert fly.read('/c', 6, 0) == b'create'
+        packed = fly.fs_structure.pack()
+        assert temp_file.stat().st_size == (
+            22 + len(MAGIC_BYTES) + 2 * SIZE_CLASSES[0] + 8 + len(packed) + len(MAGIC_BYTES) + 8
+        )
+
+    def test_create_no_space(self, tmp_path, monkeypatch):
+        temp_file = tmp_path / 'test_no_space'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+
+        def fallocate(fd, offset, length):
+            raise OSError(errno.ENOSPC, 'no space left')
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        monkeypatch.setattr(os, 'posix_fallocate', fallocate)
+        assert fly.create('/c', 0, 0o644) == -errno.ENOSPC
+        assert fly.mknod('/m', 0o644, 0) == -errno.ENOSPC
+        assert fly.fs_structure.files_list == []
+
+    def test_write_no_space(self, tmp_path, monkeypatch):
+        temp_file = tmp_path / 'test_write_no_space'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+            ttl = 300
+
+        def fallocate(fd, offset, length):
+            raise OSError(errno.ENOSPC, 'no space left')
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        fly.write('/a', b'a_content', 0)
+        fly.write('/b', b'b_content', 0)
+        file_a = fly.fs_structure.files_dict['a']
+        extent = (file_a.offset, file_a.capacity, file_a.size)
+        container_size = temp_file.stat().st_size
+
+        monkeypatch.setattr(os, 'posix_fallocate', fallocate)
+        assert fly.write('/a', b'!', SIZE_CLASSES[0]) == -errno.ENOSPC
+        assert fly.write('/new', b'new', 0) == -errno.ENOSPC
+        assert (file_a.offset, file_a.capacity, file_a.size) == extent
+        assert fly.getattr('/a').st_size == 9
+        assert 'new' not in fly.fs_structure.files_dict
+        assert temp_file.stat().st_size == container_size
+        monkeypatch.undo()
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        assert [f.name for f in fly.fs_structure.files_list] == ['a', 'b']
+        assert fly.read('/a', 9, 0) == b'a_content'
+        assert fly.read('/b', 9, 0) == b'b_content'
+
+    def test_write_no_space_fresh(self, tmp_path, monkeypatch):
+        temp_file = tmp_path / 'test_write_no_space_fresh'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+
+        def fallocate(fd, offset, length):
+            raise OSError(errno.ENOSPC, 'no space left')
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        monkeypatch.setattr(os, 'posix_fallocate', fallocate)
+        assert fly.write('/a', b'a', 0) == -errno.ENOSPC
+        assert fly.meta_offset == -1
+        assert fly.fs_structure.files_list == []
+        assert temp_file.read_bytes() == b'this_is_sample_content'
+        monkeypatch.undo()
+
+        assert fly.write('/a', b'a', 0) == 1
+        assert fly.file_wrapper.read(8, 22) == MAGIC_BYTES
+
+    def test_hole_in_the_middle_after_reload(self, tmp_path):
+        temp_file = tmp_path / 'test_hole_in_the_middle'
+        temp_file.write_bytes(b'this_is_sample_content')
+
+        class FakeArgs:
+            fname = temp_file
+            mountpoint = ''
+
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        fly.write('/a', b'a', 0)
+        fly.write('/b', b'b', 0)
+        fly.write('/c', b'c', 0)
+        fly.write('/b', b'!', SIZE_CLASSES[0])
+        frag = fly.fs_structure.fragmentation()
+        assert frag.free == SIZE_CLASSES[0]
+        assert fly.fs_structure.files_dict['a'].capacity == SIZE_CLASSES[0]
+
+        # holes aren't packed: the middle one turns into spare capacity of 'a'
+        fly = Fly()
+        fly.add_args(FakeArgs())
+        reloaded = fly.fs_structure.fragmentation()
+        assert fly.fs_structure.files_dict['a'].capacity == 2 * SIZE_CLASSES[0]
+        assert reloaded.free == 0
+        assert reloaded.reserved == frag.reserved + SIZE_CLASSES[0]